@@ -1,12 +1,20 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import os
+import re
+import json
+import zipfile
+from pathlib import Path
 from io import BytesIO
 from datetime import datetime, date
 
 # =========================
 # Configuración general
 # =========================
+# Copy-on-write: las copias superficiales de las tablas de sesión no duplican memoria hasta que se modifican
+pd.set_option("mode.copy_on_write", True)
 st.set_page_config(page_title="ERP Zapatillas", page_icon="👟", layout="wide")
 st.title("👟 ERP para marca de zapatillas")
 st.markdown("---")
@@ -18,10 +26,24 @@ TALLAS_ZAPATILLAS = [35,36,37,38,39,40,41,42,43,44,45,46]
 TALLAS_ROPA = ["XS","S","M","L","XL"]
 TIPOS_PRODUCTO = ["Zapatillas","Ropa","Otro"]
 METODOS_PAGO = ["Efectivo","Tarjeta","Transferencia"]
+UBICACIONES = ["Tienda","Bodega","Online"]
+UBICACION_DEFAULT = "Bodega"
+TALLA_COLS = [f"Talla_{t}" for t in TALLAS_ZAPATILLAS] + [f"Talla_{t}" for t in TALLAS_ROPA]
+STOCK_SLOTS = TALLA_COLS + ["SinTalla"]
+TARIFAS_DESDE = date(2000,1,1)
 
 # =========================
 # Estado inicial
 # =========================
+def default_rate_table(pct_tarjeta):
+    # Versión inicial de tarifas: la comisión de pasarela para Tarjeta, 0% para el resto
+    return pd.DataFrame({
+        "VigenteDesde": [TARIFAS_DESDE]*len(METODOS_PAGO),
+        "MetodoPago": METODOS_PAGO,
+        "MontoDesde": [0.0]*len(METODOS_PAGO),
+        "Pct": [float(pct_tarjeta) if m=="Tarjeta" else 0.0 for m in METODOS_PAGO]
+    })
+
 def init_state():
     if "df_inventario" not in st.session_state:
         base_cols = ["Tipo","Producto","Código","Categoría","Proveedor","Precio","CostoDirecto"]
@@ -30,7 +52,7 @@ def init_state():
         st.session_state.df_inventario = pd.DataFrame(columns=base_cols+shoe_cols+ropa_cols+["StockTotal"])
     if "df_ventas" not in st.session_state:
         st.session_state.df_ventas = pd.DataFrame(columns=[
-            "Fecha","Producto","Tipo","Talla","Cantidad","Comprador","PrecioVenta","MetodoPago","Comision"
+            "Fecha","Producto","Tipo","Talla","Cantidad","Comprador","PrecioVenta","MetodoPago","Comision","Ubicacion"
         ])
     if "df_gastos" not in st.session_state:
         st.session_state.df_gastos = pd.DataFrame(columns=["Fecha","Tipo","Monto","Nota"])
@@ -46,10 +68,22 @@ def init_state():
         st.session_state.comision_pasarela = 3.5
     if "iva_pct" not in st.session_state:
         st.session_state.iva_pct = 19.0
+    if "df_tarifas" not in st.session_state:
+        st.session_state.df_tarifas = default_rate_table(st.session_state.comision_pasarela)
     if "saldo_inicial" not in st.session_state:
         st.session_state.saldo_inicial = 0.0
     if "ventas_num_items" not in st.session_state:
         st.session_state.ventas_num_items = 1
+    if "scan_cart" not in st.session_state:
+        st.session_state.scan_cart = []
+    if "cli_stats" not in st.session_state:
+        st.session_state.cli_stats = pd.DataFrame({
+            "CantidadCompras": pd.Series(dtype="int64"),
+            "MontoTotal": pd.Series(dtype="float64"),
+            "PrimeraCompra": pd.Series(dtype="datetime64[ns]"),
+            "UltimaCompra": pd.Series(dtype="datetime64[ns]"),
+            "TicketPromedio": pd.Series(dtype="float64"),
+        }, index=pd.Index([], name="Comprador"))
 
 init_state()
 
@@ -57,12 +91,17 @@ init_state()
 # Utilidades
 # =========================
 DATE_FMT = "%Y-%m-%d"
+DATE_COLUMNS = {"df_ventas": ["Fecha"], "df_gastos": ["Fecha"]}
 
 def to_date_str(d):
     if isinstance(d,(date,datetime)):
         return d.strftime(DATE_FMT)
     return pd.to_datetime(d).strftime(DATE_FMT)
 
+def date_text(values):
+    # Columna de fechas (Timestamps, textos o mezcla) a texto DATE_FMT; lo no interpretable queda vacío
+    return pd.to_datetime(values, errors="coerce", format="mixed").dt.strftime(DATE_FMT)
+
 def download_excel(df_dict):
     output = BytesIO()
     with pd.ExcelWriter(output,engine="xlsxwriter") as writer:
@@ -86,17 +125,55 @@ def compute_stock_total_row(row):
         total += int(row.get(col,0) or 0)
     return int(total)
 
-def compute_commission(precio_venta, metodo_pago):
-    if metodo_pago == "Tarjeta":
-        pct = st.session_state.comision_pasarela/100.0
-        return float(precio_venta)*pct
-    return 0.0
+# =========================
+# Precios: comisiones e IVA vectorizados
+# =========================
+def _rate_table():
+    t = st.session_state.df_tarifas.dropna(subset=["VigenteDesde","MetodoPago","Pct"])
+    return pd.DataFrame({
+        "MetodoPago": t["MetodoPago"].astype(str).values,
+        "VigenteDesde": pd.to_datetime(t["VigenteDesde"]).astype("datetime64[ns]").values,
+        "MontoDesde": pd.to_numeric(t["MontoDesde"], errors="coerce").fillna(0.0).values,
+        "Pct": pd.to_numeric(t["Pct"], errors="coerce").values
+    }).dropna(subset=["Pct"])
+
+def compute_commissions(sales):
+    # Tarifa vigente a la fecha de cada venta (por método y tramo de monto). Sin versión vigente o bajo el primer tramo: 0%
+    montos = pd.to_numeric(sales["PrecioVenta"], errors="coerce").fillna(0.0)
+    metodos = sales["MetodoPago"].fillna("Efectivo").astype(str) if "MetodoPago" in sales.columns else pd.Series("Efectivo", index=sales.index)
+    pct = np.zeros(len(sales))
+    tarifas = _rate_table()
+    if not tarifas.empty and len(sales):
+        left = pd.DataFrame({
+            "_pos": np.arange(len(sales)),
+            "Fecha": pd.to_datetime(sales["Fecha"], errors="coerce").astype("datetime64[ns]").values,
+            "MetodoPago": metodos.values,
+            "Monto": montos.values
+        }).dropna(subset=["Fecha"])
+        versiones = tarifas[["MetodoPago","VigenteDesde"]].drop_duplicates().sort_values("VigenteDesde")
+        left = pd.merge_asof(left.sort_values("Fecha"), versiones, left_on="Fecha", right_on="VigenteDesde", by="MetodoPago")
+        left = left.dropna(subset=["VigenteDesde"])
+        tramos = tarifas.sort_values("MontoDesde")
+        left = pd.merge_asof(left.sort_values("Monto"), tramos, left_on="Monto", right_on="MontoDesde", by=["MetodoPago","VigenteDesde"])
+        left = left.dropna(subset=["Pct"])
+        pct[left["_pos"].to_numpy()] = left["Pct"].to_numpy()
+    return montos*pct/100.0
+
+def pasarela_changed():
+    # Cambiar la comisión de pasarela crea (o reemplaza) la versión de Tarjeta vigente desde hoy
+    t = st.session_state.df_tarifas
+    hoy = (t["MetodoPago"]=="Tarjeta") & (pd.to_datetime(t["VigenteDesde"], errors="coerce")==pd.Timestamp(date.today()))
+    nueva = pd.DataFrame([{"VigenteDesde": date.today(), "MetodoPago": "Tarjeta", "MontoDesde": 0.0, "Pct": float(st.session_state.cfg_pasarela)}])
+    st.session_state.df_tarifas = pd.concat([t[~hoy], nueva], ignore_index=True)
+
+def net_of_iva(montos):
+    return pd.to_numeric(montos, errors="coerce").fillna(0.0)/(1+st.session_state.iva_pct/100.0)
 
 # =========================
 # Inventario: agregar/ajustar
 # =========================
 def add_product(tipo, nombre, codigo, categoria, proveedor, precio, costo, stocks_por_talla, stock_otro=None):
-    df = ensure_inventory_columns(st.session_state.df_inventario.copy())
+    df = ensure_inventory_columns(st.session_state.df_inventario.copy(deep=False))
     record = {
         "Tipo": tipo,
         "Producto": nombre.strip(),
@@ -122,53 +199,847 @@ def add_product(tipo, nombre, codigo, categoria, proveedor, precio, costo, stock
     else:
         record["StockTotal"] = int(stock_otro or 0)
 
-    st.session_state.df_inventario = pd.concat([df, pd.DataFrame([record])], ignore_index=True)
+    set_table("df_inventario", append_rows(df, pd.DataFrame([record])))
     st.success("Producto agregado al inventario.")
 
-def decrement_inventory_for_sale(producto, tipo, talla, cantidad):
-    inv = ensure_inventory_columns(st.session_state.df_inventario.copy())
+# =========================
+# Stock por ubicación (ubicación × producto × talla)
+# =========================
+def _consolidated_matrix(inv):
+    m = np.zeros((len(inv), len(STOCK_SLOTS)), dtype=np.int32)
+    m[:, :-1] = inv[TALLA_COLS].apply(pd.to_numeric, errors="coerce").fillna(0).to_numpy(dtype=np.int32)
+    otro = ~inv["Tipo"].isin(["Zapatillas","Ropa"]).to_numpy()
+    m[otro, -1] = pd.to_numeric(inv["StockTotal"], errors="coerce").fillna(0).to_numpy(dtype=np.int32)[otro]
+    return m
+
+def align_location_stock(inv, prev, prev_prod):
+    # Alinea el arreglo con el inventario; diferencias hechas fuera (altas, edición de tabla) van a la ubicación por defecto
+    productos = inv["Producto"].astype(str).tolist()
+    stock = np.zeros((len(UBICACIONES), len(productos), len(STOCK_SLOTS)), dtype=np.int32)
+    if prev is not None and prev.shape[1]:
+        prev_pos = pd.Series(np.arange(prev.shape[1]), index=prev_prod)
+        src = prev_pos[~prev_pos.index.duplicated()].reindex(productos).to_numpy()
+        ok = ~np.isnan(src)
+        stock[:, ok, :] = prev[:, src[ok].astype(int), :]
+    d = UBICACIONES.index(UBICACION_DEFAULT)
+    stock[d] += _consolidated_matrix(inv) - stock.sum(axis=0)
+    for l in range(len(UBICACIONES)):
+        if l != d:
+            take = np.minimum(stock[l], np.maximum(-stock[d], 0))
+            stock[l] -= take
+            stock[d] += take
+    np.maximum(stock[d], 0, out=stock[d])
+    return stock, productos
+
+def sync_location_stock():
+    inv_raw = st.session_state.df_inventario
+    if st.session_state.get("stock_ubic_src") is inv_raw:
+        return
+    stock, productos = align_location_stock(ensure_inventory_columns(inv_raw), st.session_state.get("stock_ubic"), st.session_state.get("stock_ubic_prod"))
+    st.session_state.stock_ubic = stock
+    st.session_state.stock_ubic_prod = productos
+    st.session_state.stock_ubic_src = inv_raw
+
+def stock_slot(tipo, talla):
+    if tipo in ["Zapatillas","Ropa"]:
+        col = f"Talla_{talla}"
+        return TALLA_COLS.index(col) if col in TALLA_COLS else None
+    return len(TALLA_COLS)
+
+def location_available(pos, tipo, talla, ubicacion):
+    sync_location_stock()
+    slot = stock_slot(tipo, talla)
+    if slot is None:
+        return None
+    return int(st.session_state.stock_ubic[UBICACIONES.index(ubicacion), pos, slot])
+
+def _set_inventory_from_locations(inv, i):
+    tot = st.session_state.stock_ubic[:, i, :].sum(axis=0)
+    inv.loc[i, TALLA_COLS] = tot[:-1]
+    inv.at[i,"StockTotal"] = int(tot.sum())
+    st.session_state.df_inventario = inv
+    st.session_state.stock_ubic_src = inv
+
+def sale_location(sale):
+    ubicacion = sale.get("Ubicacion", None)
+    return ubicacion if ubicacion in UBICACIONES else UBICACION_DEFAULT
+
+def decrement_inventory_for_sale(producto, tipo, talla, cantidad, ubicacion=UBICACION_DEFAULT):
+    sync_location_stock()
+    inv = ensure_inventory_columns(st.session_state.df_inventario.copy(deep=False))
     idxs = inv.index[inv["Producto"]==producto]
     if len(idxs)==0:
         st.error(f"Producto no encontrado: {producto}")
         return False
     i = idxs[0]
-    if tipo in ["Zapatillas","Ropa"]:
-        talla_col = f"Talla_{talla}"
-        if talla_col not in inv.columns:
-            st.error(f"Talla no válida: {talla}")
-            return False
-        stock = int(inv.at[i,talla_col] or 0)
-        if stock < cantidad:
-            st.warning(f"Stock insuficiente {producto} talla {talla}. Disponible {stock}, solicitado {cantidad}.")
-            return False
-        inv.at[i,talla_col] = stock - cantidad
-    else:
-        stock_total = int(inv.at[i,"StockTotal"] or 0)
-        if stock_total < cantidad:
-            st.warning(f"Stock insuficiente {producto}. Disponible {stock_total}, solicitado {cantidad}.")
-            return False
-        inv.at[i,"StockTotal"] = stock_total - cantidad
-    inv.at[i,"StockTotal"] = compute_stock_total_row(inv.loc[i])
-    st.session_state.df_inventario = inv
+    slot = stock_slot(tipo, talla)
+    if slot is None:
+        st.error(f"Talla no válida: {talla}")
+        return False
+    l = UBICACIONES.index(ubicacion)
+    stock = int(st.session_state.stock_ubic[l, i, slot])
+    if stock < cantidad:
+        detalle = f" talla {talla}" if tipo in ["Zapatillas","Ropa"] else ""
+        st.warning(f"Stock insuficiente {producto}{detalle} en {ubicacion}. Disponible {stock}, solicitado {cantidad}.")
+        return False
+    st.session_state.stock_ubic[l, i, slot] -= cantidad
+    _set_inventory_from_locations(inv, i)
     return True
 
-def increment_inventory_for_sale(producto, tipo, talla, cantidad):
-    inv = ensure_inventory_columns(st.session_state.df_inventario.copy())
+def increment_inventory_for_sale(producto, tipo, talla, cantidad, ubicacion=UBICACION_DEFAULT):
+    sync_location_stock()
+    inv = ensure_inventory_columns(st.session_state.df_inventario.copy(deep=False))
     idxs = inv.index[inv["Producto"]==producto]
     if len(idxs)==0:
         return False
     i = idxs[0]
-    if tipo in ["Zapatillas","Ropa"]:
-        talla_col = f"Talla_{talla}"
-        if talla_col not in inv.columns:
+    slot = stock_slot(tipo, talla)
+    if slot is None:
+        return False
+    st.session_state.stock_ubic[UBICACIONES.index(ubicacion), i, slot] += cantidad
+    _set_inventory_from_locations(inv, i)
+    return True
+
+def transfer_stock(orders):
+    # Órdenes: Producto, Talla, Cantidad, Origen, Destino. Se aplican todas o ninguna.
+    sync_location_stock()
+    stock = st.session_state.stock_ubic
+    inv = ensure_inventory_columns(st.session_state.df_inventario)
+    orders = orders.dropna(subset=["Producto","Origen","Destino"])
+    if orders.empty:
+        return "No hay órdenes de transferencia."
+    prod_pos = pd.Series(np.arange(len(inv)), index=inv["Producto"].astype(str))
+    p = prod_pos[~prod_pos.index.duplicated()].reindex(orders["Producto"].astype(str)).to_numpy()
+    tipos = inv["Tipo"].to_numpy()[np.nan_to_num(p, nan=0).astype(int)] if len(inv) else np.array([])
+    s = np.array([stock_slot(t, str(talla).strip()) for t, talla in zip(tipos, orders["Talla"])], dtype=float)
+    o = pd.Index(UBICACIONES).get_indexer(orders["Origen"])
+    d = pd.Index(UBICACIONES).get_indexer(orders["Destino"])
+    q = pd.to_numeric(orders["Cantidad"], errors="coerce").fillna(0).to_numpy(dtype=np.int64)
+    if np.isnan(p).any() or np.isnan(s).any() or (o<0).any() or (d<0).any() or (q<=0).any():
+        return "Órdenes inválidas: revisa producto, talla, ubicaciones y cantidades."
+    p, s = p.astype(int), s.astype(int)
+    pedido = np.zeros(stock.shape, dtype=np.int64)
+    np.add.at(pedido, (o, p, s), q)
+    if (pedido > stock).any():
+        return "Stock insuficiente en origen para una o más transferencias."
+    np.subtract.at(stock, (o, p, s), q)
+    np.add.at(stock, (d, p, s), q)
+    return None
+
+def location_totals():
+    sync_location_stock()
+    return pd.DataFrame(
+        st.session_state.stock_ubic.sum(axis=2).T,
+        index=pd.Index(st.session_state.stock_ubic_prod, name="Producto"),
+        columns=UBICACIONES
+    )
+
+def location_stock_frame():
+    sync_location_stock()
+    stock = st.session_state.stock_ubic
+    L, P, S = stock.shape
+    df = pd.DataFrame(stock.reshape(L*P, S), columns=STOCK_SLOTS)
+    df.insert(0, "Producto", np.tile(np.array(st.session_state.stock_ubic_prod, dtype=object), L))
+    df.insert(0, "Ubicacion", np.repeat(np.array(UBICACIONES, dtype=object), P))
+    return df
+
+def location_stock_arrays(df):
+    # Inversa de location_stock_frame; el inventario restaurado manda sobre los totales
+    productos = df.loc[df["Ubicacion"]==UBICACIONES[0], "Producto"].astype(str).tolist()
+    stock = np.zeros((len(UBICACIONES), len(productos), len(STOCK_SLOTS)), dtype=np.int32)
+    for l, ubicacion in enumerate(UBICACIONES):
+        bloque = df[df["Ubicacion"]==ubicacion]
+        if len(bloque)==len(productos):
+            stock[l] = bloque.reindex(columns=STOCK_SLOTS).fillna(0).to_numpy(dtype=np.int32)
+    return stock, productos
+
+# =========================
+# Clientes: agregados incrementales y RFM
+# =========================
+def customer_stats_from(sales):
+    if sales.empty:
+        return st.session_state.cli_stats.iloc[0:0].copy()
+    base = pd.DataFrame({
+        "Comprador": sales["Comprador"].values,
+        "Fecha": pd.to_datetime(sales["Fecha"]).values,
+        "Monto": pd.to_numeric(sales["PrecioVenta"], errors="coerce").fillna(0.0).values
+    })
+    stats = base.groupby("Comprador", observed=True).agg(
+        CantidadCompras=("Monto","count"),
+        MontoTotal=("Monto","sum"),
+        PrimeraCompra=("Fecha","min"),
+        UltimaCompra=("Fecha","max")
+    )
+    stats["TicketPromedio"] = stats["MontoTotal"]/stats["CantidadCompras"]
+    return stats
+
+def customer_index_from(sales):
+    return dict(sales.groupby("Comprador", observed=True).indices) if not sales.empty else {}
+
+def rebuild_customer_index():
+    sales = st.session_state.df_ventas
+    st.session_state.cli_index = customer_index_from(sales)
+    st.session_state.cli_stats = customer_stats_from(sales)
+
+def customer_index_append(new_sales, start):
+    # Solo se agregan las filas nuevas: posiciones al índice y sumas/mín/máx a los agregados
+    if new_sales.empty:
+        return
+    index = st.session_state.cli_index
+    for comprador, pos in new_sales.reset_index(drop=True).groupby("Comprador", observed=True).indices.items():
+        pos = pos + start
+        prev = index.get(comprador)
+        index[comprador] = pos if prev is None else np.concatenate([prev, pos])
+    nuevos = customer_stats_from(new_sales)
+    stats = st.session_state.cli_stats
+    tocados = stats.index.isin(nuevos.index)
+    merged = pd.concat([stats[tocados], nuevos]).groupby(level=0).agg(
+        CantidadCompras=("CantidadCompras","sum"),
+        MontoTotal=("MontoTotal","sum"),
+        PrimeraCompra=("PrimeraCompra","min"),
+        UltimaCompra=("UltimaCompra","max")
+    )
+    merged["TicketPromedio"] = merged["MontoTotal"]/merged["CantidadCompras"]
+    st.session_state.cli_stats = pd.concat([stats[~tocados], merged])
+
+def customer_index_update(old_sales, old_pos, new_pos):
+    # old_pos/new_pos: filas conservadas (posición antes y después de guardar); el resto de df_ventas son filas nuevas.
+    # Solo se recalculan los clientes con filas eliminadas, nuevas o con Comprador/Fecha/Monto cambiados.
+    new_sales = st.session_state.df_ventas
+    old_pos = np.asarray(old_pos, dtype=np.int64)
+    new_pos = np.asarray(new_pos, dtype=np.int64)
+    compradores_old = old_sales["Comprador"].astype(object).to_numpy()
+    compradores_new = new_sales["Comprador"].astype(object).to_numpy()
+    o = old_sales.iloc[old_pos]
+    n = new_sales.iloc[new_pos]
+    cambio = (compradores_old[old_pos] != compradores_new[new_pos]) \
+        | (pd.to_numeric(o["PrecioVenta"], errors="coerce").to_numpy() != pd.to_numeric(n["PrecioVenta"], errors="coerce").to_numpy()) \
+        | (pd.to_datetime(o["Fecha"]).to_numpy() != pd.to_datetime(n["Fecha"]).to_numpy())
+    conservada = np.zeros(len(old_sales), dtype=bool)
+    conservada[old_pos] = True
+    nueva = np.ones(len(new_sales), dtype=bool)
+    nueva[new_pos] = False
+    afectados = set(compradores_old[~conservada]) | set(compradores_old[old_pos[cambio]]) \
+        | set(compradores_new[new_pos[cambio]]) | set(compradores_new[nueva])
+    afectados = {c for c in afectados if pd.notna(c)}
+
+    # Clientes no afectados: mismas filas, solo cambian de posición
+    remap = np.full(len(old_sales), -1, dtype=np.int64)
+    remap[old_pos] = new_pos
+    index = {c: remap[p] for c, p in st.session_state.cli_index.items() if c not in afectados}
+    stats = st.session_state.cli_stats
+    stats = stats[~stats.index.isin(list(afectados))]
+    if afectados:
+        pos = np.flatnonzero(pd.Series(compradores_new).isin(list(afectados)).to_numpy())
+        sub = new_sales.iloc[pos]
+        for comprador, p in sub.reset_index(drop=True).groupby("Comprador", observed=True).indices.items():
+            index[comprador] = pos[p]
+        stats = pd.concat([stats, customer_stats_from(sub)])
+    st.session_state.cli_index = index
+    st.session_state.cli_stats = stats
+
+def customer_sales(comprador):
+    pos = st.session_state.cli_index.get(comprador, np.array([], dtype=int))
+    return st.session_state.df_ventas.iloc[pos]
+
+if "cli_index" not in st.session_state:
+    rebuild_customer_index()
+
+def _rfm_score(values):
+    return np.ceil(values.rank(method="average", pct=True)*5).clip(1,5).astype(int)
+
+def compute_rfm(stats, ref_date=None):
+    if stats.empty:
+        return pd.DataFrame(columns=["Recencia","Frecuencia","Monetario","R","F","M","RFM","Segmento"])
+    ref = pd.Timestamp(ref_date or date.today())
+    rfm = pd.DataFrame(index=stats.index)
+    rfm["Recencia"] = (ref - pd.to_datetime(stats["UltimaCompra"])).dt.days
+    rfm["Frecuencia"] = stats["CantidadCompras"].astype(int)
+    rfm["Monetario"] = stats["MontoTotal"].astype(float)
+    rfm["R"] = _rfm_score(-rfm["Recencia"])
+    rfm["F"] = _rfm_score(rfm["Frecuencia"])
+    rfm["M"] = _rfm_score(rfm["Monetario"])
+    rfm["RFM"] = rfm["R"].astype(str) + rfm["F"].astype(str) + rfm["M"].astype(str)
+    r, f = rfm["R"], rfm["F"]
+    rfm["Segmento"] = np.select(
+        [(r>=4)&(f>=4), (r<=2)&(f>=3), f>=4, (r>=4)&(f<=2), r>=3],
+        ["Campeones","En riesgo","Leales","Nuevos","Potenciales"],
+        default="Perdidos"
+    )
+    return rfm
+
+# =========================
+# Ventas: registro y venta rápida
+# =========================
+def validate_sale_items(items, ubicacion=UBICACION_DEFAULT):
+    # Suma lo pedido por producto/talla/ubicación antes de tocar el stock
+    sync_location_stock()
+    productos = ensure_inventory_columns(st.session_state.df_inventario)["Producto"]
+    pedido = {}
+    for it in items:
+        producto = it["Producto"]
+        tipo = it["Tipo"]
+        talla = it.get("Talla", None)
+        ubic = it.get("Ubicacion", ubicacion)
+        idxs = np.flatnonzero((productos==producto).to_numpy())
+        if len(idxs)==0:
+            return f"Producto no encontrado: {producto}"
+        slot = stock_slot(tipo, talla)
+        if slot is None:
+            return f"Talla no válida para {tipo}: {talla}"
+        clave = (idxs[0], slot, UBICACIONES.index(ubic))
+        pedido[clave] = pedido.get(clave, 0) + int(it["Cantidad"])
+        stock = int(st.session_state.stock_ubic[clave[2], clave[0], slot])
+        if stock < pedido[clave]:
+            detalle = f"talla {talla}" if tipo in ["Zapatillas","Ropa"] else "(Otro)"
+            return f"Stock insuficiente: {producto} {detalle} en {ubic}. Disponible {stock}, solicitado {pedido[clave]}."
+    return None
+
+def commit_sale_items(items, fecha, comprador, metodo_pago, ubicacion=UBICACION_DEFAULT):
+    # Todas las líneas o ninguna: se valida el total y, si algo falla igual, se devuelve el stock descontado
+    error = validate_sale_items(items, ubicacion)
+    if error:
+        st.warning(error)
+        return False
+    new_rows = []
+    for it in items:
+        producto = it["Producto"]
+        tipo = it["Tipo"]
+        talla = it.get("Talla", None)
+        cantidad = int(it["Cantidad"])
+        precio_venta = float(it["PrecioVenta"])
+        ubic = it.get("Ubicacion", ubicacion)
+        if not decrement_inventory_for_sale(producto, tipo, talla, cantidad, ubic):
+            for row, it_ok in zip(new_rows, items):
+                increment_inventory_for_sale(it_ok["Producto"], it_ok["Tipo"], it_ok.get("Talla", None), row["Cantidad"], row["Ubicacion"])
             return False
-        inv.at[i,talla_col] = int(inv.at[i,talla_col] or 0) + cantidad
-    else:
-        inv.at[i,"StockTotal"] = int(inv.at[i,"StockTotal"] or 0) + cantidad
-    inv.at[i,"StockTotal"] = compute_stock_total_row(inv.loc[i])
-    st.session_state.df_inventario = inv
+        new_rows.append({
+            "Fecha": to_date_str(fecha),
+            "Producto": producto,
+            "Tipo": tipo,
+            "Talla": str(talla) if talla is not None else "-",
+            "Cantidad": cantidad,
+            "Comprador": comprador.strip(),
+            "PrecioVenta": precio_venta,
+            "MetodoPago": metodo_pago,
+            "Comision": 0.0,
+            "Ubicacion": ubic
+        })
+    if new_rows:
+        new_sales_df = pd.DataFrame(new_rows)
+        new_sales_df["Comision"] = compute_commissions(new_sales_df)
+        start = len(st.session_state.df_ventas)
+        set_table("df_ventas", append_rows(st.session_state.df_ventas, new_sales_df))
+        customer_index_append(new_sales_df, start)
     return True
 
+def inventory_code_index():
+    # Código -> posición en inventario; se reconstruye solo si cambió el DataFrame de inventario
+    inv = st.session_state.df_inventario
+    if st.session_state.get("inv_code_src") is not inv:
+        index = {}
+        for pos, codigo in enumerate(inv["Código"].fillna("").astype(str).str.strip().str.upper()):
+            if codigo:
+                index.setdefault(codigo, pos)
+        st.session_state.inv_code_index = index
+        st.session_state.inv_code_src = inv
+    return st.session_state.inv_code_index
+
+def parse_talla(tipo, talla):
+    talla = str(talla or "").strip().upper()
+    if tipo == "Zapatillas":
+        return int(talla) if talla.isdigit() and int(talla) in TALLAS_ZAPATILLAS else None
+    if tipo == "Ropa":
+        return talla if talla in TALLAS_ROPA else None
+    return None
+
+def scan_line(codigo, talla, cantidad, ubicacion=UBICACION_DEFAULT):
+    pos = inventory_code_index().get(str(codigo or "").strip().upper())
+    if pos is None:
+        return f"Código no encontrado: {codigo}"
+    row = st.session_state.df_inventario.iloc[pos]
+    tipo = row["Tipo"]
+    talla_ok = parse_talla(tipo, talla)
+    if tipo in ["Zapatillas","Ropa"] and talla_ok is None:
+        return f"Talla no válida para {row['Producto']}: {talla}"
+    en_carro = sum(it["Cantidad"] for it in st.session_state.scan_cart if it["Producto"]==row["Producto"] and it["Talla"]==talla_ok and it["Ubicacion"]==ubicacion)
+    disponible = location_available(pos, tipo, talla_ok, ubicacion) - en_carro
+    if disponible < cantidad:
+        return f"Stock insuficiente {row['Producto']} en {ubicacion}. Disponible {disponible}, solicitado {cantidad}."
+    st.session_state.scan_cart.append({
+        "Producto": row["Producto"],
+        "Tipo": tipo,
+        "Talla": talla_ok,
+        "Cantidad": int(cantidad),
+        "PrecioVenta": float(row["Precio"] or 0.0)*int(cantidad),
+        "Ubicacion": ubicacion
+    })
+    return None
+
+# =========================
+# Búsqueda de productos (índice de prefijos y trigramas)
+# =========================
+SEARCH_FIELDS = {"Producto":3.0,"Código":3.0,"Categoría":1.0,"Proveedor":1.0}
+SEARCH_SPLIT = r"[^0-9a-z]+"
+
+def normalize_text(values):
+    return values.fillna("").astype(str).str.normalize("NFKD").str.encode("ascii","ignore").str.decode("ascii").str.lower()
+
+def _trigrams(texto):
+    texto = f"  {texto} "
+    return {texto[k:k+3] for k in range(len(texto)-2)}
+
+def build_product_search_index(inv):
+    inv = inv.reset_index(drop=True)
+    n = len(inv)
+    tokens, posiciones, pesos = [], [], []
+    for col, peso in SEARCH_FIELDS.items():
+        textos = normalize_text(inv[col]) if col in inv.columns else pd.Series([""]*n, dtype=object)
+        tok = textos.str.split(SEARCH_SPLIT, regex=True).explode()
+        tok = tok[tok.fillna("")!=""]
+        tokens.append(tok.values.astype(object))
+        posiciones.append(tok.index.values.astype(np.int64))
+        pesos.append(np.full(len(tok), peso))
+    tokens = np.concatenate(tokens) if tokens else np.array([], dtype=object)
+    orden = np.argsort(tokens, kind="stable")
+
+    # Texto de los cuatro campos (separados por salto de línea para no casar entre campos)
+    textos = None
+    for col in SEARCH_FIELDS:
+        campo = normalize_text(inv[col]) if col in inv.columns else pd.Series([""]*n, dtype=object)
+        textos = campo if textos is None else textos + "\n" + campo
+    textos = textos.to_numpy(dtype=object) if textos is not None else np.array([], dtype=object)
+    postings = {}
+    for pos, texto in enumerate(textos):
+        for g in _trigrams(texto):
+            postings.setdefault(g, []).append(pos)
+    return {
+        "n": n,
+        "texto": textos,
+        "tokens": tokens[orden],
+        "pos": np.concatenate(posiciones)[orden],
+        "peso": np.concatenate(pesos)[orden],
+        "trigramas": {g: np.array(p, dtype=np.int64) for g, p in postings.items()}
+    }
+
+def product_search_index():
+    # Se reconstruye solo si cambian las columnas buscables, no por movimientos de stock
+    inv = st.session_state.df_inventario
+    if st.session_state.get("inv_search_src") is not inv:
+        cols = [c for c in SEARCH_FIELDS if c in inv.columns]
+        huella = hash(pd.util.hash_pandas_object(inv[cols].astype(str), index=False).values.tobytes())
+        if st.session_state.get("inv_search_huella") != huella or "inv_search_index" not in st.session_state:
+            st.session_state.inv_search_index = build_product_search_index(inv)
+            st.session_state.inv_search_huella = huella
+        st.session_state.inv_search_src = inv
+    return st.session_state.inv_search_index
+
+def search_products(query, limit=20):
+    # Devuelve posiciones de inventario ordenadas por relevancia (para el selector de venta)
+    idx = product_search_index()
+    q = normalize_text(pd.Series([query])).iloc[0].strip()
+    terms = [t for t in re.split(SEARCH_SPLIT, q) if t]
+    if not terms or idx["n"]==0:
+        return np.array([], dtype=np.int64)
+    scores = np.zeros(idx["n"])
+    for t in terms:
+        lo = np.searchsorted(idx["tokens"], t, side="left")
+        hi = np.searchsorted(idx["tokens"], t+"\uffff", side="left")
+        if hi > lo:
+            term_score = np.zeros(idx["n"])
+            exacto = (idx["tokens"][lo:hi]==t)*1.0
+            np.maximum.at(term_score, idx["pos"][lo:hi], idx["peso"][lo:hi]*(1.0+exacto))
+            scores += term_score
+    # Subcadena exacta (como el antiguo str.contains) y similitud por trigramas
+    textos = idx["texto"]
+    substring = np.zeros(idx["n"], dtype=bool)
+    if len(q) < 3:
+        substring = pd.Series(textos).str.contains(q, regex=False).to_numpy()
+    else:
+        grams = {q[k:k+3] for k in range(len(q)-2)}
+        listas = [idx["trigramas"][g] for g in grams if g in idx["trigramas"]]
+        if listas:
+            frac = np.bincount(np.concatenate(listas), minlength=idx["n"])/len(grams)
+            scores += np.where(frac>=0.5, 2.0*frac, 0.0)
+            todos = np.flatnonzero(frac==1.0)
+            substring[todos] = [q in textos[k] for k in todos]
+    scores += 3.0*substring
+    cand = np.flatnonzero(scores>0)
+    if limit is not None and len(cand) > limit:
+        cand = cand[np.argpartition(-scores[cand], limit)[:limit]]
+    return cand[np.argsort(-scores[cand], kind="stable")]
+
+def match_products(query):
+    # Filtro estricto: cada término debe aparecer como subcadena; devuelve posiciones en orden original
+    idx = product_search_index()
+    q = normalize_text(pd.Series([query])).iloc[0].strip()
+    terms = [t for t in re.split(SEARCH_SPLIT, q) if t]
+    if not terms or idx["n"]==0:
+        return np.array([], dtype=np.int64)
+    textos = idx["texto"]
+    cand = np.arange(idx["n"])
+    for t in sorted(terms, key=len, reverse=True):
+        if len(t) >= 3:
+            # Los trigramas del término acotan los candidatos antes de verificar la subcadena
+            for g in {t[k:k+3] for k in range(len(t)-2)}:
+                cand = np.intersect1d(cand, idx["trigramas"].get(g, np.array([], dtype=np.int64)), assume_unique=True)
+        cand = cand[np.fromiter((t in textos[k] for k in cand), dtype=bool, count=len(cand))]
+        if len(cand)==0:
+            break
+    return cand
+
+def product_options(query, limit=50, full_catalog_max=200):
+    productos = st.session_state.df_inventario["Producto"]
+    if query:
+        return productos.iloc[search_products(query, limit)].tolist()
+    if len(productos) > full_catalog_max:
+        st.caption(f"Mostrando {full_catalog_max} de {len(productos)} productos. Usa el buscador para ver el resto.")
+    return productos.iloc[:full_catalog_max].tolist()
+
+@st.fragment
+def scan_sale_entry():
+    # Fragmento: cada línea escaneada solo re-ejecuta este bloque, no toda la app
+    ubicacion = st.selectbox("Ubicación de venta", UBICACIONES, index=UBICACIONES.index(UBICACION_DEFAULT), key="scan_ubicacion")
+    with st.form("scan_form", clear_on_submit=True):
+        c1,c2,c3 = st.columns([2,1,1])
+        with c1:
+            codigo = st.text_input("Código (escanear o escribir)", key="scan_codigo")
+        with c2:
+            talla = st.text_input("Talla", key="scan_talla")
+        with c3:
+            cantidad = st.number_input("Cantidad", min_value=1, value=1, step=1, key="scan_cant")
+        if st.form_submit_button("Agregar línea"):
+            error = scan_line(codigo, talla, int(cantidad), ubicacion)
+            if error:
+                st.warning(error)
+
+    cart = st.session_state.scan_cart
+    if not cart:
+        st.info("Carro vacío.")
+        return
+    cart_df = pd.DataFrame(cart)
+    cart_df["Talla"] = cart_df["Talla"].map(lambda t: "-" if t is None else str(t))
+    st.dataframe(cart_df, use_container_width=True)
+    st.metric("Total carro", f"${cart_df['PrecioVenta'].sum():,.0f}")
+
+    c1,c2,c3 = st.columns([2,1,1])
+    with c1:
+        comprador = st.text_input("Nombre del comprador", key="scan_comprador")
+    with c2:
+        metodo_pago = st.selectbox("Método de pago", METODOS_PAGO, key="scan_metodo_pago")
+    with c3:
+        fecha = st.date_input("Fecha", datetime.today(), key="scan_fecha")
+    b1,b2 = st.columns(2)
+    if b1.button("Confirmar venta", key="scan_confirmar"):
+        if not comprador:
+            st.error("Ingresa el nombre del comprador.")
+        elif commit_sale_items(cart, fecha, comprador, metodo_pago):
+            st.session_state.scan_cart = []
+            st.rerun()
+    if b2.button("Vaciar carro", key="scan_vaciar"):
+        st.session_state.scan_cart = []
+        st.rerun(scope="fragment")
+
+# =========================
+# Datos para gráficos (top N, granularidad automática y caché)
+# =========================
+CHART_TOP_N = 15
+CHART_OTROS = "Otros"
+GRANULARIDAD = {"D":"día","W":"semana","M":"mes"}
+
+def top_n_series(serie, n=CHART_TOP_N):
+    serie = serie.sort_values(ascending=False)
+    if len(serie) <= n:
+        return serie
+    return pd.concat([serie.iloc[:n], pd.Series({CHART_OTROS: serie.iloc[n:].sum()})])
+
+def auto_granularity(ini, fin):
+    dias = (pd.to_datetime(fin) - pd.to_datetime(ini)).days
+    if dias <= 62:
+        return "D"
+    if dias <= 366:
+        return "W"
+    return "M"
+
+def bucket_dates(fechas, freq):
+    return fechas.dt.to_period(freq).dt.start_time.rename("Fecha")
+
+def cached_chart(nombre, fuentes, params, builder):
+    # Válido mientras las tablas fuente sean los mismos objetos (cada cambio de datos crea uno nuevo)
+    cache = st.session_state.setdefault("chart_cache", {})
+    entrada = cache.get(nombre)
+    if entrada is not None and entrada[1]==params and all(a is b for a, b in zip(entrada[0], fuentes)):
+        return entrada[2]
+    datos = builder()
+    cache[nombre] = (fuentes, params, datos)
+    return datos
+
+def _in_range(df, ini, fin):
+    fechas = pd.to_datetime(df["Fecha"])
+    mask = (fechas>=pd.to_datetime(ini)) & (fechas<=pd.to_datetime(fin))
+    return df[mask], fechas[mask]
+
+def dashboard_chart_data():
+    ventas = st.session_state.df_ventas
+    return cached_chart("dashboard", (ventas,), (), lambda: top_n_series(ventas.groupby("Producto", observed=True)["PrecioVenta"].sum()))
+
+def sales_chart_data(ini, fin):
+    ventas = st.session_state.df_ventas
+    def build():
+        sf, fechas = _in_range(ventas, ini, fin)
+        freq = auto_granularity(ini, fin)
+        return {
+            "producto": top_n_series(sf.groupby("Producto", observed=True)["PrecioVenta"].sum()),
+            "talla": top_n_series(sf.groupby("Talla", observed=True)["Cantidad"].sum(), n=20),
+            "metodo": top_n_series(sf.groupby("MetodoPago", observed=True)["PrecioVenta"].sum()),
+            "tiempo": sf["PrecioVenta"].groupby(bucket_dates(fechas, freq)).sum().sort_index(),
+            "freq": freq
+        }
+    return cached_chart("reportes_ventas", (ventas,), (ini, fin), build)
+
+def expense_chart_data(ini, fin):
+    gastos = st.session_state.df_gastos
+    def build():
+        ef, _ = _in_range(gastos, ini, fin)
+        return top_n_series(ef.groupby("Tipo", observed=True)["Monto"].sum())
+    return cached_chart("reportes_gastos", (gastos,), (ini, fin), build)
+
+def cash_balance_chart_data(ini, fin):
+    ventas = st.session_state.df_ventas
+    gastos = st.session_state.df_gastos
+    params = (ini, fin, st.session_state.iva_pct, st.session_state.saldo_inicial)
+    def build():
+        freq = auto_granularity(ini, fin)
+        partes = []
+        if not ventas.empty:
+            sf, fechas = _in_range(ventas, ini, fin)
+            neto = net_of_iva(sf["PrecioVenta"]) - pd.to_numeric(sf["Comision"], errors="coerce").fillna(0.0)
+            partes.append(neto.groupby(bucket_dates(fechas, freq)).sum())
+        if not gastos.empty:
+            ef, fechas = _in_range(gastos, ini, fin)
+            partes.append(-pd.to_numeric(ef["Monto"], errors="coerce").fillna(0.0).groupby(bucket_dates(fechas, freq)).sum())
+        if not partes:
+            return pd.DataFrame(columns=["SaldoAcumulado"])
+        neto = pd.concat(partes).groupby(level=0).sum().sort_index()
+        return pd.DataFrame({"SaldoAcumulado": st.session_state.saldo_inicial + neto.cumsum()})
+    return cached_chart("flujo_saldo", (ventas, gastos), params, build)
+
+# =========================
+# Snapshots (Arrow IPC comprimido)
+# =========================
+SNAPSHOT_TABLES = ["df_inventario","df_ventas","df_gastos","df_clientes","df_proveedores","df_tarifas","stock_ubicaciones"]
+# Las carpetas de snapshot del servidor quedan confinadas a este directorio
+SNAPSHOT_BASE_DIR = Path(os.environ.get("ERP_SNAPSHOT_DIR", Path(__file__).with_name("snapshots"))).resolve()
+SNAPSHOT_SETTINGS = {
+    "low_stock_threshold": "cfg_stock_umbral",
+    "monthly_budget": "cfg_presupuesto",
+    "comision_pasarela": "cfg_pasarela",
+    "iva_pct": "cfg_iva",
+    "saldo_inicial": "cfg_saldo_inicial",
+}
+
+def _to_arrow(df):
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columnas object con tipos mezclados (p.ej. tras editar en la tabla) se guardan como texto
+        df = df.copy(deep=False)
+        for c in df.columns[df.dtypes==object]:
+            df[c] = df[c].map(lambda v: None if pd.isna(v) else str(v))
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+def _arrow_bytes(table, compression="zstd"):
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression=compression)) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+def _with_date_text(name, df):
+    cols = [c for c in DATE_COLUMNS.get(name, []) if c in df.columns]
+    return df.assign(**{c: date_text(df[c]) for c in cols}) if cols else df
+
+def _snapshot_frame(name):
+    return location_stock_frame() if name=="stock_ubicaciones" else _with_date_text(name, st.session_state[name])
+
+def snapshot_folder(nombre):
+    # Ruta relativa a SNAPSHOT_BASE_DIR; None si está vacía o escapa del directorio base
+    nombre = (nombre or "").strip()
+    if not nombre:
+        return None
+    carpeta = (SNAPSHOT_BASE_DIR/nombre).resolve()
+    return carpeta if carpeta.is_relative_to(SNAPSHOT_BASE_DIR) else None
+
+def snapshot_bytes():
+    output = BytesIO()
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name in SNAPSHOT_TABLES:
+            zf.writestr(f"{name}.arrow", _arrow_bytes(_to_arrow(_snapshot_frame(name))).to_pybytes())
+        zf.writestr("settings.json", json.dumps({k: st.session_state[k] for k in SNAPSHOT_SETTINGS}))
+    return output.getvalue()
+
+def save_snapshot_dir(path):
+    # Sin compresión: así restore_snapshot_dir puede mapear los buffers sin descomprimir
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    for name in SNAPSHOT_TABLES:
+        with pa.OSFile(str(path/f"{name}.arrow"), "wb") as f:
+            f.write(_arrow_bytes(_to_arrow(_snapshot_frame(name)), compression=None))
+    (path/"settings.json").write_text(json.dumps({k: st.session_state[k] for k in SNAPSHOT_SETTINGS}))
+
+def _apply_snapshot(tables, settings):
+    # Todo se prepara en variables locales; la sesión solo cambia si el snapshot completo se pudo procesar
+    stock_ubic = tables.pop("stock_ubicaciones", None)
+    nuevas = {name: _with_date_text(name, table.to_pandas()) for name, table in tables.items()}
+    valores = {k: settings[k] for k in SNAPSHOT_SETTINGS if k in settings}
+    if "df_inventario" in nuevas:
+        nuevas["df_inventario"] = ensure_inventory_columns(nuevas["df_inventario"])
+    if nuevas.get("df_tarifas", st.session_state.df_tarifas).empty:
+        nuevas["df_tarifas"] = default_rate_table(valores.get("comision_pasarela", st.session_state.comision_pasarela))
+    for name in COMPACT_COUNTS.keys() | COMPACT_MONEY.keys() | COMPACT_CATEGORIES.keys():
+        nuevas[name] = compact_frame(name, nuevas.get(name, st.session_state[name]))
+    prev, prev_prod = location_stock_arrays(stock_ubic.to_pandas()) if stock_ubic is not None else (None, None)
+    stock, productos = align_location_stock(ensure_inventory_columns(nuevas["df_inventario"]), prev, prev_prod)
+    cli_index = customer_index_from(nuevas["df_ventas"])
+    cli_stats = customer_stats_from(nuevas["df_ventas"])
+
+    for name, df in nuevas.items():
+        st.session_state[name] = df
+    st.session_state.stock_ubic = stock
+    st.session_state.stock_ubic_prod = productos
+    st.session_state.stock_ubic_src = nuevas["df_inventario"]
+    st.session_state.cli_index = cli_index
+    st.session_state.cli_stats = cli_stats
+    for k, widget_key in SNAPSHOT_SETTINGS.items():
+        if k in valores:
+            st.session_state[k] = valores[k]
+            st.session_state[widget_key] = valores[k]
+    st.session_state.scan_cart = []
+
+def restore_snapshot(data):
+    tables = {}
+    with zipfile.ZipFile(BytesIO(data)) as zf:
+        for name in SNAPSHOT_TABLES:
+            if f"{name}.arrow" in zf.namelist():
+                tables[name] = pa.ipc.open_file(pa.py_buffer(zf.read(f"{name}.arrow"))).read_all()
+        settings = json.loads(zf.read("settings.json")) if "settings.json" in zf.namelist() else {}
+    _apply_snapshot(tables, settings)
+
+def restore_snapshot_dir(path):
+    # Lectura con memory-map: los buffers Arrow no se copian al abrir el archivo
+    path = Path(path)
+    tables = {}
+    for name in SNAPSHOT_TABLES:
+        f = path/f"{name}.arrow"
+        if f.exists():
+            tables[name] = pa.ipc.open_file(pa.memory_map(str(f), "r")).read_all()
+    settings_file = path/"settings.json"
+    settings = json.loads(settings_file.read_text()) if settings_file.exists() else {}
+    _apply_snapshot(tables, settings)
+
+def restore_snapshot_folder():
+    nombre = st.session_state.get("snapshot_dir")
+    carpeta = snapshot_folder(nombre)
+    if carpeta is None or not carpeta.is_dir():
+        st.session_state.snapshot_msg = ("error", f"Carpeta no encontrada en {SNAPSHOT_BASE_DIR}: {nombre}")
+        return
+    try:
+        restore_snapshot_dir(carpeta)
+        st.session_state.snapshot_msg = ("success", f"Snapshot restaurado desde {carpeta}.")
+    except (pa.ArrowInvalid, OSError, ValueError, KeyError, TypeError) as e:
+        st.session_state.snapshot_msg = ("error", f"No se pudo restaurar el snapshot: {e}")
+
+def restore_snapshot_upload():
+    uploaded = st.session_state.get("snapshot_upload")
+    if uploaded is None:
+        st.session_state.snapshot_msg = ("error", "Selecciona un archivo de snapshot.")
+        return
+    try:
+        restore_snapshot(uploaded.getvalue())
+        st.session_state.snapshot_msg = ("success", "Snapshot restaurado.")
+    except (zipfile.BadZipFile, pa.ArrowInvalid, KeyError, ValueError) as e:
+        st.session_state.snapshot_msg = ("error", f"No se pudo restaurar el snapshot: {e}")
+
+# =========================
+# Memoria: compactación de tablas y reporte
+# =========================
+COMPACT_COUNTS = {"df_inventario": TALLA_COLS+["StockTotal"], "df_ventas": ["Cantidad"]}
+COMPACT_MONEY = {"df_inventario": ["Precio","CostoDirecto"], "df_ventas": ["PrecioVenta","Comision"], "df_gastos": ["Monto"]}
+COMPACT_CATEGORIES = {
+    "df_inventario": ["Tipo","Categoría","Proveedor"],
+    "df_ventas": ["Producto","Tipo","Talla","Comprador","MetodoPago","Ubicacion"],
+    "df_gastos": ["Tipo"],
+}
+MEMORY_TABLES = ["df_inventario","df_ventas","df_gastos","df_clientes","df_proveedores","df_tarifas","cli_stats"]
+
+def compact_frame(name, df):
+    # Conteos a int32, montos a float64 (sin pérdida de precisión en sumas) y textos repetidos a category.
+    # Fecha queda como texto DATE_FMT, igual que la escriben los formularios. Columnas ya compactas no se tocan.
+    cambios = {}
+    for c in COMPACT_COUNTS.get(name, []):
+        if c in df.columns and df[c].dtype != "int32":
+            cambios[c] = pd.to_numeric(df[c], errors="coerce").fillna(0).astype("int32")
+    for c in COMPACT_MONEY.get(name, []):
+        if c in df.columns and df[c].dtype != "float64":
+            cambios[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0).astype("float64")
+    for c in COMPACT_CATEGORIES.get(name, []):
+        if c in df.columns and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            cambios[c] = df[c].where(df[c].isna(), df[c].astype(str)).astype("category")
+    for c in DATE_COLUMNS.get(name, []):
+        if c in df.columns and pd.api.types.infer_dtype(df[c], skipna=True) not in ("string","empty"):
+            cambios[c] = date_text(df[c])
+    return df.assign(**cambios) if cambios else df
+
+def append_rows(df, new):
+    # Las filas nuevas adoptan los dtypes compactos de la tabla para que concat no los vuelva a object
+    new = new.copy(deep=False)
+    for c in new.columns.intersection(df.columns):
+        dtype = df[c].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            valores = new[c].where(new[c].isna(), new[c].astype(str))
+            faltan = pd.Index(valores.dropna().unique()).difference(dtype.categories)
+            if len(faltan):
+                df = df.assign(**{c: df[c].cat.add_categories(faltan)})
+            new[c] = pd.Categorical(valores, categories=df[c].cat.categories)
+        elif dtype in ("int32","float64"):
+            new[c] = pd.to_numeric(new[c], errors="coerce").fillna(0).astype(dtype)
+    return pd.concat([df, new], ignore_index=True)
+
+def compact_tables():
+    for name in COMPACT_COUNTS.keys() | COMPACT_MONEY.keys() | COMPACT_CATEGORIES.keys():
+        set_table(name, st.session_state[name])
+
+def set_table(name, df):
+    # Toda escritura de una tabla de sesión pasa por aquí para no perder la compactación
+    st.session_state[name] = compact_frame(name, df)
+
+def for_editor(df):
+    # El editor trata category como lista cerrada; se edita como texto libre
+    cats = {c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)}
+    return df.astype(cats) if cats else df
+
+def memory_report():
+    filas = []
+    for name in MEMORY_TABLES:
+        df = st.session_state[name]
+        filas.append({"Tabla": name, "Filas": len(df), "Columnas": df.shape[1], "MemoriaKB": df.memory_usage(deep=True).sum()/1024})
+    stock = st.session_state.get("stock_ubic")
+    if stock is not None:
+        filas.append({"Tabla": "stock_ubic", "Filas": stock.shape[1], "Columnas": stock.shape[2], "MemoriaKB": stock.nbytes/1024})
+    indice = st.session_state.cli_index
+    filas.append({"Tabla": "cli_index", "Filas": len(indice), "Columnas": 1, "MemoriaKB": sum(v.nbytes for v in indice.values())/1024})
+    return pd.DataFrame(filas)
+
+def column_memory(name):
+    df = st.session_state[name]
+    return pd.DataFrame({
+        "Tipo": df.dtypes.astype(str),
+        "MemoriaKB": df.memory_usage(deep=True, index=False)/1024
+    }).rename_axis("Columna").sort_values("MemoriaKB", ascending=False)
+
+if "tablas_compactas" not in st.session_state:
+    compact_tables()
+    st.session_state.tablas_compactas = True
+
 # =========================
 # Barra lateral y exportación parcial
 # =========================
@@ -176,20 +1047,55 @@ with st.sidebar:
     st.header("Configuración")
     st.session_state.low_stock_threshold = st.number_input("Umbral de stock bajo", min_value=0, value=st.session_state.low_stock_threshold, step=1, key="cfg_stock_umbral")
     st.session_state.monthly_budget = st.number_input("Presupuesto mensual de gastos", min_value=0.0, value=float(st.session_state.monthly_budget), step=500.0, key="cfg_presupuesto")
-    st.session_state.comision_pasarela = st.number_input("Comisión Pasarela (%)", min_value=0.0, value=st.session_state.comision_pasarela, step=0.1, key="cfg_pasarela")
+    st.session_state.comision_pasarela = st.number_input("Comisión Pasarela (%)", min_value=0.0, value=st.session_state.comision_pasarela, step=0.1, key="cfg_pasarela", on_change=pasarela_changed)
     st.session_state.iva_pct = st.number_input("IVA (%)", min_value=0.0, value=st.session_state.iva_pct, step=0.5, key="cfg_iva")
     st.session_state.saldo_inicial = st.number_input("Saldo inicial caja", min_value=0.0, value=float(st.session_state.saldo_inicial), step=10000.0, key="cfg_saldo_inicial")
 
+    with st.expander("Tarifas de comisión por método"):
+        st.caption("Cada fila rige desde VigenteDesde; MontoDesde define tramos. Sin versión vigente o bajo el primer tramo la comisión es 0%. Cambiar la comisión de pasarela agrega una versión de Tarjeta desde hoy.")
+        edited_tarifas = st.data_editor(
+            st.session_state.df_tarifas,
+            num_rows="dynamic",
+            use_container_width=True,
+            column_config={
+                "VigenteDesde": st.column_config.DateColumn("VigenteDesde"),
+                "MetodoPago": st.column_config.SelectboxColumn("MetodoPago", options=METODOS_PAGO),
+                "MontoDesde": st.column_config.NumberColumn("MontoDesde", min_value=0.0),
+                "Pct": st.column_config.NumberColumn("Pct", min_value=0.0),
+            },
+            key="tarifas_editor"
+        )
+        if st.button("Guardar tarifas", key="tarifas_save"):
+            st.session_state.df_tarifas = edited_tarifas.reset_index(drop=True)
+            st.success("Tarifas actualizadas.")
+        if st.button("Recalcular comisiones históricas", key="tarifas_recalc"):
+            if not st.session_state.df_ventas.empty:
+                ventas = st.session_state.df_ventas.copy(deep=False)
+                ventas["Comision"] = compute_commissions(ventas)
+                set_table("df_ventas", ventas)
+            st.success("Comisiones recalculadas.")
+
+    with st.expander("🧠 Memoria de la sesión"):
+        if st.button("Compactar tablas", key="mem_compactar"):
+            compact_tables()
+            st.success("Tablas compactadas.")
+        tabla_mem = st.selectbox("Detalle por columna", MEMORY_TABLES, key="mem_tabla")
+        # memory_usage(deep=True) recorre cada columna object: solo se calcula a pedido
+        if st.button("Calcular uso de memoria", key="mem_calcular"):
+            reporte = memory_report()
+            st.metric("Total sesión", f"{reporte['MemoriaKB'].sum():,.0f} KB")
+            st.dataframe(reporte, use_container_width=True, hide_index=True)
+            st.dataframe(column_memory(tabla_mem), use_container_width=True)
+
     st.divider()
     st.subheader("Exportar todo")
     def compute_cash_flow_df():
-        IVA = st.session_state.iva_pct/100.0
-        sales = st.session_state.df_ventas.copy()
-        exp = st.session_state.df_gastos.copy()
+        sales = st.session_state.df_ventas.copy(deep=False)
+        exp = st.session_state.df_gastos.copy(deep=False)
         if not sales.empty:
             sales["Fecha"] = pd.to_datetime(sales["Fecha"])
             sales["Mes"] = sales["Fecha"].dt.to_period("M").astype(str)
-            ingresos_netos = (sales["PrecioVenta"]/(1+IVA)).groupby(sales["Mes"]).sum().rename("IngresosNetos")
+            ingresos_netos = net_of_iva(sales["PrecioVenta"]).groupby(sales["Mes"]).sum().rename("IngresosNetos")
             comisiones = sales.groupby("Mes")["Comision"].sum().rename("Comisiones")
         else:
             ingresos_netos = pd.Series(dtype=float, name="IngresosNetos")
@@ -209,15 +1115,41 @@ with st.sidebar:
         return flujo.reset_index().rename(columns={"index":"Mes"})
 
     bytes_all = download_excel({
-        "Inventario": ensure_inventory_columns(st.session_state.df_inventario.copy()),
-        "Ventas": st.session_state.df_ventas.copy(),
-        "Gastos": st.session_state.df_gastos.copy(),
-        "Clientes": st.session_state.df_clientes.copy(),
-        "Proveedores": st.session_state.df_proveedores.copy(),
+        "Inventario": ensure_inventory_columns(st.session_state.df_inventario.copy(deep=False)),
+        "Ventas": st.session_state.df_ventas.copy(deep=False),
+        "Gastos": st.session_state.df_gastos.copy(deep=False),
+        "Clientes": st.session_state.df_clientes.copy(deep=False),
+        "Proveedores": st.session_state.df_proveedores.copy(deep=False),
         "FlujoCaja": compute_cash_flow_df()
     })
     st.download_button("Descargar Excel (completo)", data=bytes_all, file_name="erp_zapatillas.xlsx", key="export_excel_all")
 
+    st.divider()
+    st.subheader("Snapshot")
+    # Se serializa solo a pedido; el archivo preparado se ofrece una vez y se libera en el siguiente rerun
+    if st.button("Preparar snapshot", key="snapshot_prepare"):
+        st.session_state.snapshot_payload = snapshot_bytes()
+    if "snapshot_payload" in st.session_state:
+        st.download_button("Descargar snapshot", data=st.session_state.pop("snapshot_payload"), file_name="erp_zapatillas.snapshot.zip", key="snapshot_download")
+    st.file_uploader("Archivo de snapshot", type=["zip"], key="snapshot_upload")
+    st.button("Restaurar snapshot", on_click=restore_snapshot_upload, key="snapshot_restore")
+    st.text_input("Carpeta de snapshot (en el servidor)", key="snapshot_dir", help=f"Relativa a {SNAPSHOT_BASE_DIR}")
+    sd1,sd2 = st.columns(2)
+    if sd1.button("Guardar en carpeta", key="snapshot_dir_save"):
+        carpeta = snapshot_folder(st.session_state.snapshot_dir)
+        if carpeta is None:
+            st.error(f"Indica una carpeta dentro de {SNAPSHOT_BASE_DIR}.")
+        else:
+            try:
+                save_snapshot_dir(carpeta)
+                st.success(f"Snapshot guardado en {carpeta}.")
+            except OSError as e:
+                st.error(f"No se pudo guardar el snapshot: {e}")
+    sd2.button("Restaurar desde carpeta", on_click=restore_snapshot_folder, key="snapshot_dir_restore")
+    if "snapshot_msg" in st.session_state:
+        nivel, msg = st.session_state.pop("snapshot_msg")
+        st.success(msg) if nivel=="success" else st.error(msg)
+
 # =========================
 # Dashboard inicial
 # =========================
@@ -237,10 +1169,7 @@ m2.metric("💸 Gastos del mes", f"${gastos_mes:,.0f}")
 m3.metric("📈 Margen neto", f"${margen_mes:,.0f}")
 
 if not st.session_state.df_ventas.empty:
-    ventas_df = st.session_state.df_ventas.copy()
-    ventas_df["Fecha"] = pd.to_datetime(ventas_df["Fecha"])
-    ventas_prod = ventas_df.groupby("Producto")["PrecioVenta"].sum().sort_values(ascending=False)
-    st.bar_chart(ventas_prod)
+    st.bar_chart(dashboard_chart_data())
 
 st.markdown("---")
 
@@ -312,7 +1241,7 @@ with tab_inv:
         stock_bajo = st.checkbox(f"Solo stock bajo (≤ {st.session_state.low_stock_threshold})", key="stock_bajo_inv")
 
     search_inv = st.text_input("Buscar texto libre (modelo, código, categoría, proveedor)", key="inv_search")
-    inv_view = ensure_inventory_columns(st.session_state.df_inventario.copy())
+    inv_view = ensure_inventory_columns(st.session_state.df_inventario.copy(deep=False))
 
     if filtro_prov:
         inv_view = inv_view[inv_view["Proveedor"].isin(filtro_prov)]
@@ -323,29 +1252,52 @@ with tab_inv:
     if stock_bajo:
         inv_view = inv_view[inv_view["StockTotal"] <= st.session_state.low_stock_threshold]
     if not inv_view.empty and search_inv:
-        mask = np.column_stack([
-            inv_view[col].astype(str).str.contains(search_inv, case=False, na=False)
-            for col in ["Producto","Código","Categoría","Proveedor"]
-        ]).any(axis=1)
-        inv_view = inv_view[mask]
+        inv_view = inv_view[inv_view.index.isin(match_products(search_inv))]
 
     if not inv_view.empty:
         inv_view["Icono"] = inv_view["Tipo"].map({"Zapatillas":"👟","Ropa":"👕","Otro":"📦"})
 
     st.markdown("#### Editar tabla de inventario")
-    edited_inv = st.data_editor(inv_view, num_rows="dynamic", use_container_width=True, key="inv_editor")
+    edited_inv = st.data_editor(for_editor(inv_view), num_rows="dynamic", use_container_width=True, key="inv_editor")
     if st.button("Guardar cambios de inventario", key="inv_save"):
         edited_inv = ensure_inventory_columns(edited_inv)
         edited_inv["StockTotal"] = edited_inv.apply(compute_stock_total_row, axis=1)
-        st.session_state.df_inventario = edited_inv.reset_index(drop=True)
+        set_table("df_inventario", edited_inv.reset_index(drop=True))
         st.success("Inventario actualizado.")
 
     st.markdown("#### Eliminar filas de inventario")
     idx_to_delete = st.multiselect("Selecciona índices a eliminar", options=edited_inv.index.tolist(), key="inv_del_sel")
     if st.button("Eliminar seleccionados", key="inv_del_btn"):
-        st.session_state.df_inventario = edited_inv.drop(idx_to_delete).reset_index(drop=True)
+        set_table("df_inventario", edited_inv.drop(idx_to_delete).reset_index(drop=True))
         st.success("Filas eliminadas del inventario.")
 
+    st.markdown("#### Stock por ubicación")
+    st.dataframe(location_totals(), use_container_width=True)
+    with st.expander("🚚 Transferencias entre ubicaciones"):
+        ordenes = st.data_editor(
+            pd.DataFrame({
+                "Producto": pd.Series(dtype=object),
+                "Talla": pd.Series(dtype=object),
+                "Cantidad": pd.Series(dtype="int64"),
+                "Origen": pd.Series(dtype=object),
+                "Destino": pd.Series(dtype=object)
+            }),
+            num_rows="dynamic",
+            use_container_width=True,
+            column_config={
+                "Producto": st.column_config.SelectboxColumn("Producto", options=st.session_state.df_inventario["Producto"].astype(str).unique().tolist()),
+                "Origen": st.column_config.SelectboxColumn("Origen", options=UBICACIONES),
+                "Destino": st.column_config.SelectboxColumn("Destino", options=UBICACIONES),
+            },
+            key="transfer_editor"
+        )
+        if st.button("Aplicar transferencias", key="transfer_btn"):
+            error = transfer_stock(ordenes)
+            if error:
+                st.error(error)
+            else:
+                st.success("Transferencias aplicadas.")
+
     low_df = st.session_state.df_inventario[st.session_state.df_inventario["StockTotal"] <= st.session_state.low_stock_threshold]
     if low_df.empty:
         st.info("✅ No hay modelos con stock total bajo.")
@@ -357,6 +1309,11 @@ with tab_inv:
 # Ventas
 # =========================
 with tab_sales:
+    st.subheader("Venta rápida")
+    if st.toggle("Modo escáner (código + talla)", key="scan_mode"):
+        scan_sale_entry()
+
+    st.divider()
     st.subheader("Registrar venta múltiple")
 
     # Número de ítems fuera del form para re-render dinámico
@@ -364,10 +1321,18 @@ with tab_sales:
         "Número de ítems", min_value=1, value=st.session_state.ventas_num_items, step=1, key="ventas_num_items_ctrl"
     )
 
+    # Búsqueda por ítem fuera del form para que las opciones se filtren al escribir
+    busq_cols = st.columns(4)
+    busquedas = []
+    for j in range(int(st.session_state.ventas_num_items)):
+        with busq_cols[j%4]:
+            busquedas.append(st.text_input(f"Buscar producto {j+1}", key=f"venta_busq_{j}"))
+
     with st.form("venta_multiple_form", clear_on_submit=True):
         fecha_v = st.date_input("Fecha", datetime.today(), key="ventas_fecha")
         comprador = st.text_input("Nombre del comprador", key="ventas_comprador")
         metodo_pago = st.selectbox("Método de pago", METODOS_PAGO, key="ventas_metodo_pago")
+        ubicacion_v = st.selectbox("Ubicación de venta", UBICACIONES, index=UBICACIONES.index(UBICACION_DEFAULT), key="ventas_ubicacion")
 
         items = []
         for j in range(int(st.session_state.ventas_num_items)):
@@ -377,7 +1342,7 @@ with tab_sales:
             with c1:
                 producto = st.selectbox(
                     f"Producto {j+1}",
-                    st.session_state.df_inventario["Producto"].tolist(),
+                    product_options(busquedas[j]),
                     key=f"venta_prod_{j}"
                 )
                 tipo_prod = "-"
@@ -414,65 +1379,9 @@ with tab_sales:
             if not comprador:
                 st.error("Ingresa el nombre del comprador.")
             else:
-                # Validación previa de stock
-                sim_inv = ensure_inventory_columns(st.session_state.df_inventario.copy())
-                ok_all = True
-                for it in items:
-                    producto = it["Producto"]
-                    tipo = it["Tipo"]
-                    talla = it.get("Talla", None)
-                    cantidad = int(it["Cantidad"])
-                    idxs = sim_inv.index[sim_inv["Producto"]==producto]
-                    if len(idxs)==0:
-                        st.error(f"Producto no encontrado: {producto}")
-                        ok_all = False
-                        break
-                    i = idxs[0]
-                    if tipo in ["Zapatillas","Ropa"]:
-                        talla_col = f"Talla_{talla}"
-                        if talla_col not in sim_inv.columns:
-                            st.error(f"Talla no válida para {tipo}: {talla}")
-                            ok_all = False
-                            break
-                        stock = int(sim_inv.at[i,talla_col] or 0)
-                        if stock < cantidad:
-                            st.warning(f"Stock insuficiente: {producto} talla {talla}. Disponible {stock}, solicitado {cantidad}.")
-                            ok_all = False
-                            break
-                    else:
-                        stock_total = int(sim_inv.at[i,"StockTotal"] or 0)
-                        if stock_total < cantidad:
-                            st.warning(f"Stock insuficiente: {producto} (Otro). Disponible {stock_total}, solicitado {cantidad}.")
-                            ok_all = False
-                            break
-
-                # Aplicar ventas
-                if ok_all:
-                    for it in items:
-                        producto = it["Producto"]
-                        tipo = it["Tipo"]
-                        talla = it.get("Talla", None)
-                        cantidad = int(it["Cantidad"])
-                        precio_venta = float(it["PrecioVenta"])
-                        ok = decrement_inventory_for_sale(producto, tipo, talla, cantidad)
-                        if not ok:
-                            ok_all = False
-                            break
-                        comision = compute_commission(precio_venta, metodo_pago)
-                        new_sale = pd.DataFrame([{
-                            "Fecha": to_date_str(fecha_v),
-                            "Producto": producto,
-                            "Tipo": tipo,
-                            "Talla": str(talla) if talla is not None else "-",
-                            "Cantidad": cantidad,
-                            "Comprador": comprador.strip(),
-                            "PrecioVenta": precio_venta,
-                            "MetodoPago": metodo_pago,
-                            "Comision": comision
-                        }])
-                        st.session_state.df_ventas = pd.concat([st.session_state.df_ventas, new_sale], ignore_index=True)
-                    if ok_all:
-                        st.success("Venta múltiple registrada.")
+                # Valida el stock de todos los ítems y aplica la venta completa o nada
+                if commit_sale_items(items, fecha_v, comprador, metodo_pago, ubicacion_v):
+                    st.success("Venta múltiple registrada.")
 
     st.divider()
     st.subheader("Historial de ventas")
@@ -491,7 +1400,7 @@ with tab_sales:
     with colf3:
         v_fin = st.date_input("Hasta", value=datetime.today(), key="ventas_hasta")
 
-    v_view = st.session_state.df_ventas.copy()
+    v_view = st.session_state.df_ventas.copy(deep=False)
     if not v_view.empty:
         v_view["Fecha"] = pd.to_datetime(v_view["Fecha"])
         v_view = v_view[(v_view["Fecha"]>=pd.to_datetime(v_ini)) & (v_view["Fecha"]<=pd.to_datetime(v_fin))]
@@ -508,10 +1417,10 @@ with tab_sales:
             v_view = v_view[mask_v]
 
     st.markdown("#### Editar tabla de ventas (con reconciliación de stock)")
-    edited_sales = st.data_editor(v_view, num_rows="dynamic", use_container_width=True, key="ventas_editor")
+    edited_sales = st.data_editor(for_editor(v_view), num_rows="dynamic", use_container_width=True, key="ventas_editor")
 
     if st.button("Guardar cambios de ventas", key="ventas_save"):
-        old_sales = st.session_state.df_ventas.copy()
+        old_sales = st.session_state.df_ventas.copy(deep=False)
         new_sales = edited_sales.reset_index(drop=True)
 
         for _, sale in old_sales.iterrows():
@@ -519,8 +1428,10 @@ with tab_sales:
             tipo = sale["Tipo"]
             talla = sale["Talla"] if sale["Talla"]!="-" else None
             cantidad = int(sale["Cantidad"])
-            increment_inventory_for_sale(producto, tipo, talla, cantidad)
+            increment_inventory_for_sale(producto, tipo, talla, cantidad, sale_location(sale))
 
+        if not new_sales.empty:
+            new_sales["Comision"] = compute_commissions(new_sales)
         ok_all = True
         for i in range(len(new_sales)):
             sale = new_sales.iloc[i]
@@ -528,16 +1439,15 @@ with tab_sales:
             tipo = sale["Tipo"]
             talla = sale["Talla"] if sale["Talla"]!="-" else None
             cantidad = int(sale["Cantidad"])
-            precio = float(sale["PrecioVenta"])
-            metodo_pago_edit = sale["MetodoPago"] if "MetodoPago" in new_sales.columns and pd.notna(sale["MetodoPago"]) else "Efectivo"
-            new_sales.at[i,"Comision"] = compute_commission(precio, metodo_pago_edit)
-            ok = decrement_inventory_for_sale(producto, tipo, talla, cantidad)
+            ok = decrement_inventory_for_sale(producto, tipo, talla, cantidad, sale_location(sale))
             if not ok:
                 ok_all = False
                 break
 
         if ok_all:
-            st.session_state.df_ventas = new_sales
+            set_table("df_ventas", new_sales)
+            kept = edited_sales.index.isin(v_view.index)
+            customer_index_update(old_sales, edited_sales.index[kept], np.flatnonzero(kept))
             st.success("Ventas actualizadas y stock reconciliado.")
         else:
             st.error("No se pudieron aplicar todas las ventas editadas. Se mantiene el estado anterior.")
@@ -551,8 +1461,12 @@ with tab_sales:
             tipo = sale["Tipo"]
             talla = sale["Talla"] if sale["Talla"]!="-" else None
             cantidad = int(sale["Cantidad"])
-            increment_inventory_for_sale(producto, tipo, talla, cantidad)
-        st.session_state.df_ventas = edited_sales.drop(idx_v_del).reset_index(drop=True)
+            increment_inventory_for_sale(producto, tipo, talla, cantidad, sale_location(sale))
+        old_sales = st.session_state.df_ventas
+        restantes = edited_sales.drop(idx_v_del)
+        set_table("df_ventas", restantes.reset_index(drop=True))
+        kept = restantes.index.isin(v_view.index)
+        customer_index_update(old_sales, restantes.index[kept], np.flatnonzero(kept))
         st.success("Ventas eliminadas y stock devuelto.")
 
 # =========================
@@ -578,7 +1492,7 @@ with tab_exp:
                 "Monto": float(monto),
                 "Nota": (nota or "").strip()
             }])
-            st.session_state.df_gastos = pd.concat([st.session_state.df_gastos, new], ignore_index=True)
+            set_table("df_gastos", append_rows(st.session_state.df_gastos, new))
             st.success("Gasto registrado.")
 
     st.divider()
@@ -593,7 +1507,7 @@ with tab_exp:
     with colg3:
         g_fin = st.date_input("Hasta", value=datetime.today(), key="gastos_hasta")
 
-    g_view = st.session_state.df_gastos.copy()
+    g_view = st.session_state.df_gastos.copy(deep=False)
     if not g_view.empty:
         g_view["Fecha"] = pd.to_datetime(g_view["Fecha"])
         g_view = g_view[(g_view["Fecha"]>=pd.to_datetime(g_ini)) & (g_view["Fecha"]<=pd.to_datetime(g_fin))]
@@ -603,14 +1517,14 @@ with tab_exp:
             mask_g = g_view.apply(lambda r: search_g.lower() in str(r.values).lower(), axis=1)
             g_view = g_view[mask_g]
 
-    edited_exp = st.data_editor(g_view, num_rows="dynamic", use_container_width=True, key="gastos_editor")
+    edited_exp = st.data_editor(for_editor(g_view), num_rows="dynamic", use_container_width=True, key="gastos_editor")
     if st.button("Guardar cambios de gastos", key="gastos_save"):
-        st.session_state.df_gastos = edited_exp.reset_index(drop=True)
+        set_table("df_gastos", edited_exp.reset_index(drop=True))
         st.success("Gastos actualizados.")
 
     idx_g_del = st.multiselect("Selecciona índices a eliminar (gastos)", options=edited_exp.index.tolist(), key="gastos_del_sel")
     if st.button("Eliminar gastos seleccionados", key="gastos_del_btn"):
-        st.session_state.df_gastos = edited_exp.drop(idx_g_del).reset_index(drop=True)
+        set_table("df_gastos", edited_exp.drop(idx_g_del).reset_index(drop=True))
         st.success("Gastos eliminados.")
 
     if st.session_state.monthly_budget > 0:
@@ -646,7 +1560,7 @@ with tab_crm:
 
     st.divider()
     st.subheader("Clientes")
-    edited_cli = st.data_editor(st.session_state.df_clientes.copy(), num_rows="dynamic", use_container_width=True, key="cli_editor")
+    edited_cli = st.data_editor(st.session_state.df_clientes.copy(deep=False), num_rows="dynamic", use_container_width=True, key="cli_editor")
     if st.button("Guardar cambios de clientes", key="cli_save"):
         st.session_state.df_clientes = edited_cli.reset_index(drop=True)
         st.success("Clientes actualizados.")
@@ -656,11 +1570,8 @@ with tab_crm:
         st.success("Clientes eliminados.")
 
     st.subheader("Ranking de clientes")
-    if not st.session_state.df_ventas.empty:
-        ventas_cli = st.session_state.df_ventas.groupby("Comprador").agg(
-            CantidadCompras=("Producto","count"),
-            MontoTotal=("PrecioVenta","sum")
-        ).reset_index()
+    if not st.session_state.cli_stats.empty:
+        ventas_cli = st.session_state.cli_stats.rename_axis("Comprador").reset_index()
         orden = st.radio("Ordenar por:", ["Cantidad de compras","Monto total"], key="crm_orden")
         if orden=="Cantidad de compras":
             ventas_cli = ventas_cli.sort_values("CantidadCompras", ascending=False)
@@ -668,11 +1579,16 @@ with tab_crm:
             ventas_cli = ventas_cli.sort_values("MontoTotal", ascending=False)
         st.dataframe(ventas_cli, use_container_width=True)
 
+        st.subheader("Segmentación RFM")
+        rfm = compute_rfm(st.session_state.cli_stats)
+        st.bar_chart(rfm["Segmento"].value_counts(), use_container_width=True)
+        st.dataframe(rfm.rename_axis("Comprador").reset_index().sort_values("RFM", ascending=False), use_container_width=True)
+
     st.subheader("Compras por cliente")
-    if not st.session_state.df_ventas.empty:
-        cliente_sel = st.selectbox("Selecciona cliente", sorted(st.session_state.df_ventas["Comprador"].dropna().unique().tolist()), key="crm_cli_select")
-        cli_sales = st.session_state.df_ventas[st.session_state.df_ventas["Comprador"]==cliente_sel]
-        total_cli = cli_sales["PrecioVenta"].sum()
+    if st.session_state.cli_index:
+        cliente_sel = st.selectbox("Selecciona cliente", sorted(st.session_state.cli_index.keys()), key="crm_cli_select")
+        cli_sales = customer_sales(cliente_sel)
+        total_cli = st.session_state.cli_stats.at[cliente_sel,"MontoTotal"] if cliente_sel in st.session_state.cli_stats.index else 0.0
         st.metric("Total comprado (bruto)", f"${total_cli:,.0f}")
         st.dataframe(cli_sales, use_container_width=True)
 
@@ -699,7 +1615,7 @@ with tab_sup:
 
     st.divider()
     st.subheader("Proveedores")
-    edited_sup = st.data_editor(st.session_state.df_proveedores.copy(), num_rows="dynamic", use_container_width=True, key="sup_editor")
+    edited_sup = st.data_editor(st.session_state.df_proveedores.copy(deep=False), num_rows="dynamic", use_container_width=True, key="sup_editor")
     if st.button("Guardar cambios de proveedores", key="sup_save"):
         st.session_state.df_proveedores = edited_sup.reset_index(drop=True)
         st.success("Proveedores actualizados.")
@@ -719,23 +1635,23 @@ with tab_reports:
     with r2:
         r_fin = st.date_input("Hasta", value=datetime.today(), key="rep_hasta")
 
-    sales = st.session_state.df_ventas.copy()
+    sales = st.session_state.df_ventas.copy(deep=False)
     if not sales.empty:
         sales["Fecha"] = pd.to_datetime(sales["Fecha"])
         sales_f = sales[(sales["Fecha"]>=pd.to_datetime(r_ini)) & (sales["Fecha"]<=pd.to_datetime(r_fin))]
-        st.markdown("#### Ventas por modelo (brutas)")
-        by_prod = sales_f.groupby("Producto")["PrecioVenta"].sum().sort_values(ascending=False)
+        charts = sales_chart_data(r_ini, r_fin)
+        st.markdown(f"#### Ventas por modelo (brutas, top {CHART_TOP_N})")
+        by_prod = charts["producto"]
         st.bar_chart(by_prod, use_container_width=True) if not by_prod.empty else st.info("Sin ventas en el periodo.")
         st.markdown("#### Ventas por talla (pares)")
-        by_size = sales_f.groupby("Talla")["Cantidad"].sum().sort_values(ascending=False)
+        by_size = charts["talla"]
         st.bar_chart(by_size, use_container_width=True) if not by_size.empty else st.info("Sin cantidades por talla.")
         st.markdown("#### Ventas por método de pago (brutas)")
-        by_pay = sales_f.groupby("MetodoPago")["PrecioVenta"].sum().sort_values(ascending=False)
+        by_pay = charts["metodo"]
         st.bar_chart(by_pay, use_container_width=True) if not by_pay.empty else st.info("Sin datos por método de pago.")
-        st.markdown("#### Ventas por mes (brutas)")
-        sales_f["Mes"] = sales_f["Fecha"].dt.to_period("M").astype(str)
-        by_month = sales_f.groupby("Mes")["PrecioVenta"].sum().sort_values()
-        st.line_chart(by_month, use_container_width=True) if not by_month.empty else st.info("Sin ventas por mes.")
+        st.markdown(f"#### Ventas por {GRANULARIDAD[charts['freq']]} (brutas)")
+        by_time = charts["tiempo"]
+        st.line_chart(by_time, use_container_width=True) if not by_time.empty else st.info("Sin ventas en el periodo.")
 
         st.markdown("#### Modelo más vendido y cliente top")
         top_prod = sales_f["Producto"].mode().iloc[0] if not sales_f["Producto"].empty else None
@@ -748,11 +1664,8 @@ with tab_reports:
 
     st.divider()
     st.subheader("Gastos por categoría")
-    exp = st.session_state.df_gastos.copy()
-    if not exp.empty:
-        exp["Fecha"] = pd.to_datetime(exp["Fecha"])
-        exp_f = exp[(exp["Fecha"]>=pd.to_datetime(r_ini)) & (exp["Fecha"]<=pd.to_datetime(r_fin))]
-        by_cat = exp_f.groupby("Tipo")["Monto"].sum().sort_values(ascending=False)
+    if not st.session_state.df_gastos.empty:
+        by_cat = expense_chart_data(r_ini, r_fin)
         st.bar_chart(by_cat, use_container_width=True) if not by_cat.empty else st.info("Sin gastos en el periodo.")
     else:
         st.info("Aún no hay gastos registrados.")
@@ -768,15 +1681,14 @@ with tab_cf:
     with c2:
         cf_fin = st.date_input("Hasta", value=datetime.today(), key="cf_hasta")
 
-    IVA = st.session_state.iva_pct/100.0
-    sales = st.session_state.df_ventas.copy()
-    exp = st.session_state.df_gastos.copy()
+    sales = st.session_state.df_ventas.copy(deep=False)
+    exp = st.session_state.df_gastos.copy(deep=False)
 
     if not sales.empty:
         sales["Fecha"] = pd.to_datetime(sales["Fecha"])
-        sf = sales[(sales["Fecha"]>=pd.to_datetime(cf_ini)) & (sales["Fecha"]<=pd.to_datetime(cf_fin))].copy()
+        sf = sales[(sales["Fecha"]>=pd.to_datetime(cf_ini)) & (sales["Fecha"]<=pd.to_datetime(cf_fin))]
         sf["Mes"] = sf["Fecha"].dt.to_period("M").astype(str)
-        ingresos_netos_m = (sf["PrecioVenta"]/(1+IVA)).groupby(sf["Mes"]).sum().rename("IngresosNetos")
+        ingresos_netos_m = net_of_iva(sf["PrecioVenta"]).groupby(sf["Mes"]).sum().rename("IngresosNetos")
         comisiones_m = sf.groupby("Mes")["Comision"].sum().rename("Comisiones")
     else:
         ingresos_netos_m = pd.Series(dtype=float, name="IngresosNetos")
@@ -784,7 +1696,7 @@ with tab_cf:
 
     if not exp.empty:
         exp["Fecha"] = pd.to_datetime(exp["Fecha"])
-        ef = exp[(exp["Fecha"]>=pd.to_datetime(cf_ini)) & (exp["Fecha"]<=pd.to_datetime(cf_fin))].copy()
+        ef = exp[(exp["Fecha"]>=pd.to_datetime(cf_ini)) & (exp["Fecha"]<=pd.to_datetime(cf_fin))]
         ef["Mes"] = ef["Fecha"].dt.to_period("M").astype(str)
         gastos_m = ef.groupby("Mes")["Monto"].sum().rename("Gastos")
     else:
@@ -797,8 +1709,10 @@ with tab_cf:
     flujo_m["SaldoAcumulado"] = st.session_state.saldo_inicial + flujo_m["SaldoNeto"].cumsum()
 
     st.dataframe(flujo_m.reset_index().rename(columns={"index":"Mes"}), use_container_width=True)
-    if not flujo_m.empty:
-        st.line_chart(flujo_m[["SaldoAcumulado"]], use_container_width=True)
+    saldo_chart = cash_balance_chart_data(cf_ini, cf_fin)
+    if not saldo_chart.empty:
+        st.markdown(f"#### Saldo acumulado (por {GRANULARIDAD[auto_granularity(cf_ini, cf_fin)]})")
+        st.line_chart(saldo_chart, use_container_width=True)
 
 # =========================
 # Estado de resultados
@@ -811,29 +1725,28 @@ with tab_results:
     with e2:
         er_fin = st.date_input("Hasta", value=datetime.today(), key="er_hasta")
 
-    IVA = st.session_state.iva_pct/100.0
-    sales = st.session_state.df_ventas.copy()
-    exp = st.session_state.df_gastos.copy()
-    inv = ensure_inventory_columns(st.session_state.df_inventario.copy())
+    sales = st.session_state.df_ventas.copy(deep=False)
+    exp = st.session_state.df_gastos.copy(deep=False)
+    inv = ensure_inventory_columns(st.session_state.df_inventario.copy(deep=False))
 
     if not sales.empty:
         sales["Fecha"] = pd.to_datetime(sales["Fecha"])
-        sales_f = sales[(sales["Fecha"]>=pd.to_datetime(er_ini)) & (sales["Fecha"]<=pd.to_datetime(er_fin))].copy()
+        sales_f = sales[(sales["Fecha"]>=pd.to_datetime(er_ini)) & (sales["Fecha"]<=pd.to_datetime(er_fin))]
     else:
         sales_f = sales
 
     if not exp.empty:
         exp["Fecha"] = pd.to_datetime(exp["Fecha"])
-        exp_f = exp[(exp["Fecha"]>=pd.to_datetime(er_ini)) & (exp["Fecha"]<=pd.to_datetime(er_fin))].copy()
+        exp_f = exp[(exp["Fecha"]>=pd.to_datetime(er_ini)) & (exp["Fecha"]<=pd.to_datetime(er_fin))]
     else:
         exp_f = exp
 
-    ingresos_netos = float((sales_f["PrecioVenta"]/(1+IVA)).sum())
+    ingresos_netos = float(net_of_iva(sales_f["PrecioVenta"]).sum()) if not sales_f.empty else 0.0
 
     costos_directos = 0.0
     if not sales_f.empty and not inv.empty and "CostoDirecto" in inv.columns:
         inv_cost = inv.set_index("Producto")["CostoDirecto"].to_dict()
-        sales_f["CostoUnit"] = sales_f["Producto"].map(inv_cost).fillna(0.0)
+        sales_f["CostoUnit"] = pd.to_numeric(sales_f["Producto"].astype(object).map(inv_cost), errors="coerce").fillna(0.0)
         costos_directos = float((sales_f["CostoUnit"]*sales_f["Cantidad"]).sum())
 
     comisiones = float(sales_f["Comision"].sum()) if "Comision" in sales_f.columns else 0.0
@@ -862,10 +1775,10 @@ with tab_results:
 st.divider()
 st.subheader("Exportar datos")
 bytes_all_final = download_excel({
-    "Inventario": ensure_inventory_columns(st.session_state.df_inventario.copy()),
-    "Ventas": st.session_state.df_ventas.copy(),
-    "Gastos": st.session_state.df_gastos.copy(),
-    "Clientes": st.session_state.df_clientes.copy(),
-    "Proveedores": st.session_state.df_proveedores.copy()
+    "Inventario": ensure_inventory_columns(st.session_state.df_inventario.copy(deep=False)),
+    "Ventas": st.session_state.df_ventas.copy(deep=False),
+    "Gastos": st.session_state.df_gastos.copy(deep=False),
+    "Clientes": st.session_state.df_clientes.copy(deep=False),
+    "Proveedores": st.session_state.df_proveedores.copy(deep=False)
 })
 st.download_button("Descargar Excel (todos)", data=bytes_all_final, file_name="erp_zapatillas_todo.xlsx", key="export_excel_all_bottom")
@@ -0,0 +1,214 @@
+"""Prueba de carga sin navegador para Erpazlaoficial.py.
+
+Simula varias sesiones simultáneas con streamlit.testing.v1.AppTest y mide la
+latencia de cada rerun (p50/p95/p99) y el pico de memoria por escenario y
+tamaño de dataset. El pico de memoria es el de una sola sesión, medido en una
+pasada aparte que no se cronometra.
+
+    python loadtest_erp.py --sizes 1000,20000 --sessions 8 --iterations 5
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from streamlit.testing.v1 import AppTest
+
+APP_FILE = str(Path(__file__).with_name("Erpazlaoficial.py"))
+TALLAS_ZAPATILLAS = [35,36,37,38,39,40,41,42,43,44,45,46]
+TALLAS_ROPA = ["XS","S","M","L","XL"]
+METODOS_PAGO = ["Efectivo","Tarjeta","Transferencia"]
+
+# =========================
+# Datos sintéticos
+# =========================
+def build_dataset(n_ventas, seed=0):
+    rng = np.random.default_rng(seed)
+    n_prod = max(10, n_ventas//20)
+    inv = pd.DataFrame({
+        "Tipo": "Zapatillas",
+        "Producto": [f"Modelo {k:05d}" for k in range(n_prod)],
+        "Código": [f"Z{k:05d}" for k in range(n_prod)],
+        "Categoría": rng.choice(["Running","Urbana","Trail","Básquet"], n_prod),
+        "Proveedor": rng.choice(["Proveedor A","Proveedor B","Proveedor C"], n_prod),
+        "Precio": rng.integers(30, 150, n_prod)*1000.0,
+        "CostoDirecto": rng.integers(10, 60, n_prod)*1000.0,
+    })
+    for t in TALLAS_ZAPATILLAS:
+        inv[f"Talla_{t}"] = rng.integers(50, 500, n_prod)
+    for t in TALLAS_ROPA:
+        inv[f"Talla_{t}"] = 0
+    inv["StockTotal"] = inv[[f"Talla_{t}" for t in TALLAS_ZAPATILLAS]].sum(axis=1)
+
+    hoy = date.today()
+    prod = rng.integers(0, n_prod, n_ventas)
+    metodo = rng.choice(METODOS_PAGO, n_ventas)
+    precio = inv["Precio"].to_numpy()[prod]
+    ventas = pd.DataFrame({
+        "Fecha": [(hoy - timedelta(days=int(d))).strftime("%Y-%m-%d") for d in rng.integers(0, 730, n_ventas)],
+        "Producto": inv["Producto"].to_numpy()[prod],
+        "Tipo": "Zapatillas",
+        "Talla": rng.choice(TALLAS_ZAPATILLAS, n_ventas).astype(str),
+        "Cantidad": 1,
+        "Comprador": [f"Cliente {k:04d}" for k in rng.integers(0, max(10, n_ventas//5), n_ventas)],
+        "PrecioVenta": precio,
+        "MetodoPago": metodo,
+        "Comision": np.where(metodo=="Tarjeta", precio*0.035, 0.0),
+        "Ubicacion": "Bodega",
+    })
+    gastos = pd.DataFrame({
+        "Fecha": [(hoy - timedelta(days=int(d))).strftime("%Y-%m-%d") for d in rng.integers(0, 730, n_ventas//10+1)],
+        "Tipo": rng.choice(["Marketing","Envíos","Otros"], n_ventas//10+1),
+        "Monto": rng.integers(5, 200, n_ventas//10+1)*1000.0,
+        "Nota": "",
+    })
+    return {"df_inventario": inv, "df_ventas": ventas, "df_gastos": gastos}
+
+def write_fixture(dataset, path):
+    # Mismo formato que save_snapshot_dir: IPC sin comprimir, una tabla por archivo
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    for name, df in dataset.items():
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.OSFile(str(path/f"{name}.arrow"), "wb") as f, pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+    (path/"settings.json").write_text(json.dumps({}))
+    return path.name
+
+# =========================
+# Sesiones y flujos
+# =========================
+def new_session(fixture, timeout):
+    # Se carga por "Restaurar desde carpeta" para que la app reconstruya stock, compactación e índice de clientes
+    at = AppTest.from_file(APP_FILE, default_timeout=timeout)
+    at.run()
+    at.text_input(key="snapshot_dir").input(fixture)
+    at.button(key="snapshot_dir_restore").click().run()
+    if at.session_state["cli_stats"].empty:
+        raise RuntimeError("El snapshot de carga no reconstruyó el índice de clientes")
+    return at
+
+def _button(at, label):
+    return next(b for b in at.button if b.label == label)
+
+def flow_venta_multiple(at, k):
+    at.number_input(key="ventas_num_items_ctrl").set_value(3).run()
+    productos = at.session_state["df_inventario"]["Producto"].tolist()
+    at.selectbox(key="ventas_ubicacion").select("Bodega")
+    at.text_input(key="ventas_comprador").input(f"Carga {k}")
+    for j in range(3):
+        at.selectbox(key=f"venta_prod_{j}").select(productos[(k*3+j) % min(len(productos), 200)])
+        at.number_input(key=f"venta_prec_{j}").set_value(50000.0)
+    _button(at, "Registrar venta múltiple").click()
+    antes = len(at.session_state["df_ventas"])
+    def check():
+        if len(at.session_state["df_ventas"]) != antes+3:
+            avisos = "; ".join(w.value for w in at.warning)
+            raise RuntimeError(f"La venta múltiple no se registró: {avisos or 'sin aviso'}")
+    return check
+
+def flow_editar_ventas(at, k):
+    # AppTest no edita celdas del data_editor; la edición se hace con el control de la app que elimina
+    # filas de la tabla editada, que también reconcilia stock y actualiza el índice de clientes
+    at.date_input(key="ventas_desde").set_value(date.today() - timedelta(days=800)).run()
+    ventas = at.session_state["df_ventas"]
+    fila = (k*37) % len(ventas)
+    comprador = str(ventas["Comprador"].iloc[fila])
+    antes = len(ventas)
+    at.multiselect(key="ventas_del_sel").set_value([fila])
+    _button(at, "Eliminar ventas seleccionadas").click()
+    def check():
+        ventas = at.session_state["df_ventas"]
+        if len(ventas) != antes-1:
+            raise RuntimeError(f"La venta {fila} no se eliminó")
+        total = ventas.loc[ventas["Comprador"].astype(str)==comprador, "PrecioVenta"].sum()
+        stats = at.session_state["cli_stats"]
+        registrado = stats.loc[comprador, "MontoTotal"] if comprador in stats.index else 0.0
+        if not np.isclose(registrado, total):
+            raise RuntimeError(f"El índice de clientes no refleja la eliminación de {comprador}")
+    return check
+
+def flow_rango_reportes(at, k):
+    hoy = date.today()
+    at.date_input(key="rep_desde").set_value(hoy - timedelta(days=30*(k % 24 + 1)))
+    at.date_input(key="rep_hasta").set_value(hoy)
+
+def flow_exportar(at, k):
+    # Se mide la construcción del snapshot al pedirlo
+    at.button(key="snapshot_prepare").click()
+    def check():
+        if not at.get("download_button"):
+            raise RuntimeError("No apareció el botón de descarga del snapshot")
+    return check
+
+FLOWS = {
+    "venta_multiple": flow_venta_multiple,
+    "editar_ventas": flow_editar_ventas,
+    "rango_reportes": flow_rango_reportes,
+    "exportar": flow_exportar,
+}
+
+def run_session(flow, fixture, iterations, timeout):
+    at = new_session(fixture, timeout)
+    latencias = []
+    for k in range(iterations):
+        check = flow(at, k)
+        t0 = time.perf_counter()
+        at.run()
+        latencias.append((time.perf_counter()-t0)*1000.0)
+        if at.exception:
+            raise RuntimeError(f"Excepción en la app: {at.exception[0].message}")
+        if check:
+            check()
+    return latencias
+
+def run_scenario(name, fixture, sessions, iterations, concurrency, timeout):
+    # Latencia sin tracemalloc (lo hace varias veces más lento); la memoria se mide aparte con una sola sesión
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run_session, FLOWS[name], fixture, iterations, timeout) for _ in range(sessions)]
+        latencias = np.concatenate([f.result() for f in futures])
+    tracemalloc.start()
+    try:
+        run_session(FLOWS[name], fixture, iterations, timeout)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    p50, p95, p99 = np.percentile(latencias, [50, 95, 99])
+    return {"Escenario": name, "Reruns": len(latencias), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "PicoMemoria_MB": peak/2**20}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000", help="Ventas por dataset, separadas por coma")
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--scenarios", default=",".join(FLOWS))
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    filas = []
+    for size in [int(x) for x in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory(prefix="erp_carga_") as tmp:
+            # La app solo lee carpetas dentro de ERP_SNAPSHOT_DIR
+            os.environ["ERP_SNAPSHOT_DIR"] = tmp
+            fixture = write_fixture(build_dataset(size), Path(tmp)/f"ventas_{size}")
+            for name in args.scenarios.split(","):
+                res = run_scenario(name, fixture, args.sessions, args.iterations, args.concurrency, args.timeout)
+                res["Ventas"] = size
+                filas.append(res)
+                print(f"{size:>8} {name:<16} p50={res['p50_ms']:.0f}ms p95={res['p95_ms']:.0f}ms p99={res['p99_ms']:.0f}ms pico={res['PicoMemoria_MB']:.1f}MB", flush=True)
+
+    cols = ["Ventas","Escenario","Reruns","p50_ms","p95_ms","p99_ms","PicoMemoria_MB"]
+    print()
+    print(pd.DataFrame(filas)[cols].to_string(index=False, float_format=lambda v: f"{v:.1f}"))
+
+if __name__ == "__main__":
+    main()